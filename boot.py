@@ -4,48 +4,126 @@ import storage
 import digitalio
 import time
 
-# Setup buttons D1 and D2 as inputs with pull-ups
-d1 = digitalio.DigitalInOut(board.D1)
-d1.direction = digitalio.Direction.INPUT
+# Remount "/" writable for the MCU, skipping the remount if it already is
+def enable_mcu_write():
+    try:
+        if not storage.getmount("/").readonly:
+            return True
+    except AttributeError:
+        # Older CircuitPython without getmount/readonly - just remount
+        pass
+    try:
+        storage.remount("/", readonly=False)
+        return True
+    except (RuntimeError, OSError) as e:
+        print(f"Error remounting storage: {e}")
+        return False
 
+# Setup buttons D1 and D2 as inputs (board has pull-downs, so they're active HIGH)
+# DigitalInOut already starts out as an input, so no direction setup is needed
+d1 = digitalio.DigitalInOut(board.D1)
 d2 = digitalio.DigitalInOut(board.D2)
-d2.direction = digitalio.Direction.INPUT
 
-print("Booting up...")
-print("Hold D1 or D2 to keep storage read-only to device (write for PC).")
-time.sleep(1.500)  # Allow time for the user to press buttons
+# Bind the time functions once so the poll loops skip the module attribute lookups
+monotonic = time.monotonic
+sleep = time.sleep
+
+# Short poll window instead of a fixed sleep - exit as soon as a button is seen
+# Each sample reads both pins once into locals (pull-down, button press gives True)
+# and the last sample is reused below rather than reading the pins again.
+# A press only counts if a second read 2ms later agrees (two-sample debounce)
+deadline = monotonic() + 0.15
+while True:
+    d1_value = d1.value
+    d2_value = d2.value
+    if d1_value or d2_value:
+        sleep(0.002)
+        d1_value = d1_value and d1.value
+        d2_value = d2_value and d2.value
+        if d1_value or d2_value:
+            break
+    if monotonic() >= deadline:
+        break
+    sleep(0.005)
+button_pressed = d1_value or d2_value
+
+# Release the pins straight away if they aren't needed for the hold check,
+# so the DigitalInOut objects don't sit on the heap while we print and remount
+counters = None
+if not button_pressed:
+    d1.deinit()
+    d2.deinit()
+else:
+    # Hand the pressed pins over to edge counters before printing anything, so a release
+    # during the prints is still counted; any falling edge (buttons are active HIGH) means
+    # it wasn't held. Without countio (or if a pin can't be counted) the pins are polled instead
+    pressed_pins = [pin for pin, value in ((board.D1, d1_value), (board.D2, d2_value)) if value]
+    try:
+        import countio
+
+        counters = []
+        d1.deinit()
+        d2.deinit()
+        for pin in pressed_pins:
+            counters.append(countio.Counter(pin, edge=countio.Edge.FALL))
+    except ImportError:
+        pass
+    except (ValueError, RuntimeError) as e:
+        print(f"Edge counter unavailable ({e}), polling instead")
+        for counter in counters:
+            counter.deinit()
+        counters = None
+        d1 = digitalio.DigitalInOut(board.D1)
+        d2 = digitalio.DigitalInOut(board.D2)
+
+print("\n".join([
+    "Booting up...",
+    "Hold D1 or D2 to keep storage read-only to device (write for PC).",
+    f"D1: {d1_value}, D2: {d2_value}",
+]))
 
-print(f"D1: {d1.value}, D2: {d2.value}")
-# Check if buttons are pressed (with pull-up, button press gives False)
-button_pressed = d1.value or d2.value
+held = False
+# If at least one button is pressed, wait for 2 seconds to confirm
+if button_pressed:
+    print("Button(s) detected! Hold for 2 seconds to keep storage read-only to MCU...")
+    held = True
+    # No cleanup afterwards - the pins and counters are released when boot.py's VM
+    # finishes, so main.py gets them back without a deinit/re-init toggle here
+    if counters is not None:
+        # Sleep through the window, then it only counts as held if no release edge was seen
+        # and every pressed pin still reads pressed
+        sleep(2.0)
+        held = sum(counter.count for counter in counters) == 0
+        for counter in counters:
+            counter.deinit()
+        held = held and all(digitalio.DigitalInOut(pin).value for pin in pressed_pins)
+    else:
+        # Poll every 20ms and bail out as soon as both are released
+        # Seconds remaining are shown on one line, overwritten with '\r'
+        t_end = monotonic() + 2.0
+        shown = None
+        while True:
+            remaining = t_end - monotonic()
+            if remaining <= 0:
+                break
+            if int(remaining) + 1 != shown:
+                shown = int(remaining) + 1
+                print(f"\rRead-only hold: {shown}s ", end="")
+            if not d1.value and not d2.value:
+                held = False
+                break
+            sleep(0.02)
+        print()
 
-try:
-    # If at least one button is pressed, wait for 2 seconds to confirm
+# If buttons were held for the full duration
+if held:
+    print("Buttons held! Storage remains read-only for MCU.")
+else:
+    # Remount first, then print - lets the CDC drain overlap the flash work
+    write_enabled = enable_mcu_write()
     if button_pressed:
-        print("Button(s) detected! Hold for 2 seconds to keep storage read-only to MCU...")
-        countdown = 2
-        
-        # Count down while checking if buttons are still held
-        while countdown > 0 and (d1.value or d2.value):
-            print(f"Keeping read-only for MCU in {countdown} seconds...")
-            time.sleep(1)
-            countdown -= 1
-        
-        # If buttons were held for the full duration
-        if countdown == 0 and (d1.value or d2.value):
-            print("Buttons held! Storage remains read-only for MCU.")
-        else:
-            print("Button released. Enabling flash write access to MCU.")
-            storage.remount("/", readonly=False)
-            print("Storage mounted with write access enabled to MCU.")
+        print("Button released. Enabling flash write access to MCU.")
     else:
         print("No buttons pressed. Enabling write access to MCU...")
-        # No buttons pressed, enable write access
-        storage.remount("/", readonly=False)
+    if write_enabled:
         print("Storage mounted with write access to MCU enabled.")
-
-    # Clean up
-    d1.deinit()
-    d2.deinit()
-except Exception as e:
-    print(f"An error occurred: {e}")
\ No newline at end of file
@@ -2,28 +2,28 @@
 # For CircuitPython 9 on ESP32-S2 Reverse TFT Feather with VL53L0X/VL53L1X sensor
 
 import time
-import traceback
+import gc
 import board
 import busio
 import digitalio
 import displayio
 import terminalio
-import adafruit_vl53l0x
 import adafruit_max1704x
 import supervisor
 import wifi
-import socketpool
-import ssl
-import adafruit_requests
 import microcontroller
 import alarm
-import json
 import os
-# Import ScrollingLabel for better text display
-from adafruit_display_text import label, scrolling_label
+import struct
+import array
+import rtc
 
 # Configuration from settings.toml
-ADAFRUIT_AIO_URL = "https://io.adafruit.com/api/v2/"
+# Plain HTTP skips the TLS handshake (much faster on the ESP32-S2) but sends the AIO key unencrypted
+INSECURE_HTTP = str(os.getenv("DISTANCE_MONITOR_INSECURE_HTTP", "0")) == "1"
+if INSECURE_HTTP:
+    print("WARNING: DISTANCE_MONITOR_INSECURE_HTTP set, posting to Adafruit IO without TLS")
+ADAFRUIT_AIO_URL = "http://io.adafruit.com/api/v2/" if INSECURE_HTTP else "https://io.adafruit.com/api/v2/"
 
 # Check for required credentials with fallbacks
 ADAFRUIT_USERNAME = os.getenv("ADAFRUIT_AIO_USERNAME", "")
@@ -36,16 +36,26 @@ if not ADAFRUIT_KEY:
 
 # Oil Tank Feed
 FEED_NAME = os.getenv("ADAFRUIT_AIO_FEED_NAME", "oil-tank-depth")
+BATTERY_FEED_NAME = FEED_NAME + "-bat"
 
 # Error feed name for posting sensor errors
 ERROR_FEED_NAME = os.getenv("ADAFRUIT_AIO_ERROR_FEED_NAME", "error")
 
+# Group the feeds are posted through together - a single reading, the battery voltage and
+# an error go out in one request. Set to "" to post each feed separately
+GROUP_NAME = os.getenv("ADAFRUIT_AIO_GROUP_NAME", "default")
+
 
 # Time settings with defaults
-REPORT_INTERVAL = int(os.getenv("DISTANCE_MONITOR_REPORT_INTERVAL", "10800"))  # 3 hours in seconds (default)
+REPORT_INTERVAL = int(os.getenv("DISTANCE_MONITOR_REPORT_INTERVAL", "10800"))  # 3 hours in seconds between level checks (default)
 MIN_REPORT_INTERVAL = int(os.getenv("DISTANCE_MONITOR_MIN_REPORT_INTERVAL", "86400"))  # 24 hours in seconds (default)
 AWAKE_TIME = int(os.getenv("DISTANCE_MONITOR_AWAKE_TIME", "30"))  # seconds to stay awake after button press (default)
+DEBOUNCE_TIME = 0.3  # seconds a button stays disarmed after a press
 MAX_STORED_READINGS = int(os.getenv("DISTANCE_MONITOR_MAX_STORED_READINGS", "5"))  # number of previous readings to store (default)
+SENSOR_SAMPLES = int(os.getenv("DISTANCE_MONITOR_SENSOR_SAMPLES", "5"))  # samples per reading, the median is used (default)
+SENSOR_TIMING_BUDGET_MS = int(os.getenv("DISTANCE_MONITOR_SENSOR_TIMING_BUDGET_MS", "100"))  # ms per sample (default)
+REPORT_BATCH_SIZE = int(os.getenv("DISTANCE_MONITOR_REPORT_BATCH_SIZE", "1"))  # readings to queue before uploading them in one request (default)
+MAX_PENDING_POINTS = 100  # cap on queued readings/errors kept while uploads keep failing
 
 # Default hysteresis - can be overridden in settings.toml or by user via buttons
 DEFAULT_HYSTERESIS = float(os.getenv("DISTANCE_MONITOR_DEFAULT_HYSTERESIS", "2.0"))  # 2cm change threshold (default)
@@ -61,13 +71,143 @@ WIFI_PASSWORD = os.getenv("CIRCUITPY_WIFI_PASSWORD", "")
 if not WIFI_PASSWORD:
     print("WARNING: CIRCUITPY_WIFI_PASSWORD not set in settings.toml")
 
-# First, let's define a UI elements class to hold references to the display elements we'll update
+# Networking objects are created on first use and reused for the rest of the wake cycle
+_POOL = None
+_SSL = None
+_REQUESTS = None
+
+# Adafruit IO URL prefix and headers built once rather than on every post
+_AIO_BASE = ADAFRUIT_AIO_URL + ADAFRUIT_USERNAME
+_FEEDS_URL = _AIO_BASE + "/feeds"
+_HEADERS = {
+    "X-AIO-Key": ADAFRUIT_KEY,
+    "Content-Type": "application/json",
+    "Connection": "keep-alive"  # ask the server to hold the socket open for the next post
+}
+_FEED_URLS = {}  # full post URL per (feed, endpoint), filled in as each one is first used
+_GROUPS_URL = _AIO_BASE + "/groups"
+_GROUP_DATA_URL = _GROUPS_URL + "/" + GROUP_NAME + "/data"
+
+# NTP server for setting the clock - one 48-byte UDP exchange rather than an HTTPS request
+NTP_SERVER = "pool.ntp.org"
+NTP_TO_UNIX_SECONDS = 2208988800  # NTP counts from 1900, time.localtime() from 1970
+_RTC = rtc.RTC()  # bound once rather than constructed on each clock sync
+
+# UI elements class - builds the labels into the display group once and holds on to the ones we'll update
 class UIElements:
-    def __init__(self):
-        self.current_distance_label = None
-        self.hysteresis_label = None
-        self.countdown_label = None
+    def __init__(self, main_group, metrics, past_readings, past_index, hysteresis):
+        # Only wakes that show something load the text modules (quiet timer wakes never get here)
+        from adafruit_display_text import label, bitmap_label
+        
+        # Last values shown, so labels are only re-rendered when they change
+        self.shown_distance = None
+        self.shown_hysteresis = None
+        self.shown_countdown = None
+        self.shown_past_index = None
+        self.shown_newest_past = None
+        self.shown_battery = None
+        
+        # Layout is fixed for the display, so it's passed in precomputed (see DISPLAY_METRICS)
+        display_width, display_height, x_margin, y_start, y_spacing, title_scale, reading_scale, info_scale = metrics
+        
+        # Set up text area for title - this never changes
+        title_text = label.Label(terminalio.FONT, text="Distance Monitor", scale=title_scale)
+        title_text.x = x_margin
+        title_text.y = y_start
+        main_group.append(title_text)
+        
+        # Current reading - a placeholder until update() fills it in
+        current_y = y_start + y_spacing
+        self.current_distance_label = label.Label(
+            terminalio.FONT, 
+            text="Current: ---.- cm", 
+            scale=reading_scale
+        )
+        self.current_distance_label.x = x_margin
+        self.current_distance_label.y = current_y
+        main_group.append(self.current_distance_label)
+        
+        # Past readings section header - this never changes
+        history_y = current_y + y_spacing
+        hysteresis_y = history_y
+        history_title = label.Label(terminalio.FONT, text="Past Readings:", scale=info_scale)
+        history_title.x = x_margin
+        history_title.y = history_y
+        main_group.append(history_title)
+        
+        # One label per past reading that fits on screen, filled in by update_past_readings below
+        # The rows share a sub-group that carries their indent, so each label only sets its y
+        history_group = displayio.Group(x=x_margin + 10)
+        main_group.append(history_group)
         self.past_reading_labels = []
+        for reading_y in HISTORY_Y:
+            history_text = label.Label(terminalio.FONT, text="", scale=info_scale)
+            history_text.y = reading_y
+            history_group.append(history_text)
+            self.past_reading_labels.append(history_text)
+        update_past_readings(self, past_readings, past_index)
+        
+        # Bottom section - settings
+        settings_y = SETTINGS_Y
+        
+        # Hysteresis setting
+        # bitmap_label renders into one bitmap, which is cheaper to redraw than per-glyph tiles
+        hysteresis_str = "Hysteresis: %.1fcm" % hysteresis
+        self.hysteresis_label = bitmap_label.Label(
+            terminalio.FONT, 
+            text=hysteresis_str, 
+            scale=info_scale,
+            save_text=False
+        )
+        hysteresis_width = len(hysteresis_str) * 6 * info_scale
+        right_x_margin = display_width - hysteresis_width - x_margin
+        self.hysteresis_label.x = right_x_margin
+        self.hysteresis_label.y = hysteresis_y # settings_y
+        main_group.append(self.hysteresis_label)
+        self.shown_hysteresis = hysteresis
+        
+        # Battery voltage
+        self.battery_label = label.Label(
+            terminalio.FONT, 
+            text="Battery: --.-V", 
+            scale=info_scale
+        )
+        self.battery_label.x = right_x_margin
+        self.battery_label.y = int((hysteresis_y + settings_y) / 2)
+        main_group.append(self.battery_label)
+        if battery_level > 0:
+            update_battery_label(self)  # the voltage read at startup, until a report reads it again
+        
+        # Countdown timer - position on right side
+        self.countdown_label = bitmap_label.Label(
+            terminalio.FONT, 
+            text="Sleep in: --s", 
+            scale=info_scale,
+            save_text=False
+        )
+        self.countdown_label.x = right_x_margin
+        self.countdown_label.y = settings_y
+        main_group.append(self.countdown_label)
+        
+        # Button labels - these never change, and sit in a footer sub-group positioned once
+        button_group = displayio.Group(x=x_margin, y=BUTTONS_Y)
+        main_group.append(button_group)
+        for i, legend in enumerate(BUTTON_LEGENDS):
+            btn_label = label.Label(terminalio.FONT, text=legend, scale=info_scale)
+            btn_label.x = i * BUTTON_WIDTH
+            button_group.append(btn_label)
+
+    # Bring the retained labels up to date - each helper skips labels whose value hasn't changed
+    def update(self, current_distance, past_readings, past_index, hysteresis):
+        update_current_distance(self, current_distance)
+        update_past_readings(self, past_readings, past_index)
+        update_hysteresis(self, hysteresis)
+
+# Backlight pin, looked up once - None on boards without a dedicated TFT_BACKLIGHT
+try:
+    TFT_BACKLIGHT_PIN = board.TFT_BACKLIGHT
+except AttributeError:
+    TFT_BACKLIGHT_PIN = None
 
 # Setup display and backlight
 def setup_display():
@@ -78,10 +218,10 @@ def setup_display():
     backlight = None
     try:
         # First try the dedicated TFT_BACKLIGHT pin if available
-        if hasattr(board, 'TFT_BACKLIGHT'):
+        if TFT_BACKLIGHT_PIN is not None:
             # Check if the pin is already in use
             try:
-                backlight = digitalio.DigitalInOut(board.TFT_BACKLIGHT)
+                backlight = digitalio.DigitalInOut(TFT_BACKLIGHT_PIN)
                 backlight.direction = digitalio.Direction.OUTPUT
                 backlight.value = True  # Turn on the backlight
             except ValueError as e:
@@ -98,23 +238,25 @@ def setup_display():
     # Use root_group assignment instead of show() in CircuitPython 9
     display.root_group = main_group
     
+    # Refresh manually so several label changes go out in one refresh instead of one each
+    display.auto_refresh = False
+    
     return display, main_group, backlight
 
-# Setup buttons
+# Setup buttons - returned as parallel sequences (pins, DigitalInOut objects, pressed levels)
+# indexed by button number, so lookups are plain indexing rather than dict access
 def setup_buttons():
     # Define which buttons are active LOW (default) and which are active HIGH
-    button_configs = [
-        {"pin": board.D0, "active_low": True},  # D0 is active LOW (pressed = LOW)
-        {"pin": board.D1, "active_low": False}, # D1 is active HIGH (pressed = HIGH)
-        {"pin": board.D2, "active_low": False}  # D2 is active HIGH (pressed = HIGH)
-    ]
+    button_pins = (board.D0, board.D1, board.D2)
+    button_active_low = (
+        True,   # D0 is active LOW (pressed = LOW)
+        False,  # D1 is active HIGH (pressed = HIGH)
+        False   # D2 is active HIGH (pressed = HIGH)
+    )
     
-    buttons = []
+    button_dios = []
     
-    for config in button_configs:
-        pin = config["pin"]
-        active_low = config["active_low"]
-        
+    for pin, active_low in zip(button_pins, button_active_low):
         try:
             btn = digitalio.DigitalInOut(pin)
             btn.direction = digitalio.Direction.INPUT
@@ -124,189 +266,87 @@ def setup_buttons():
                 btn.pull = digitalio.Pull.UP  # Pull up for active LOW buttons
             else:
                 btn.pull = digitalio.Pull.DOWN  # Pull down for active HIGH buttons
-                
-            # Store DigitalInOut object, pin, and active state
-            buttons.append({
-                "dio": btn, 
-                "pin": pin,
-                "active_low": active_low
-            })
+            
+            button_dios.append(btn)
         except Exception as e:
             print(f"Error setting up button {pin}: {e}")
-            # Create a placeholder if button setup fails
-            buttons.append({
-                "dio": None,
-                "pin": pin,
-                "active_low": active_low
-            })
+            # Use a placeholder if button setup fails
+            button_dios.append(None)
     
-    return buttons
+    # The level each button reads when pressed
+    button_pressed = tuple(not active_low for active_low in button_active_low)
+    
+    return button_pins, button_dios, button_pressed
 
-# Function to create the initial display interface - only called once
-def setup_display_interface(main_group, current_distance, past_readings, hysteresis):
+# Function to build the display interface - safe to call again, since once the labels exist
+# they're just brought up to date (the current reading shows a placeholder until it's known)
+def build_display_interface(main_group, metrics, past_readings, past_index, hysteresis):
+    if ui_elements is not None and len(main_group) > 0:
+        update_past_readings(ui_elements, past_readings, past_index)
+        update_hysteresis(ui_elements, hysteresis)
+        return ui_elements
+    
     # Clear the display
     while len(main_group) > 0:
         main_group.pop()
     
-    # Create a UI elements object to store references
-    ui_elements = UIElements()
-    
-    # Get screen dimensions
-    display_width = board.DISPLAY.width if hasattr(board.DISPLAY, 'width') else 320
-    display_height = board.DISPLAY.height if hasattr(board.DISPLAY, 'height') else 240
-    
-    # Adjust text scale based on screen size
-    title_scale = 2 if display_width >= 240 else 1
-    reading_scale = 2 if display_width >= 240 else 1
-    info_scale = 1
-    
-    # Calculate margins and spacing based on display size
-    x_margin = int(display_width * 0.05)  # 5% margin
-    y_start = int(display_height * 0.1)   # Start 10% from top
-    y_spacing = int(display_height * 0.13)  # Spacing is 16% of height
-    
-    # Set up text area for title - this never changes
-    title_text = label.Label(terminalio.FONT, text="Distance Monitor", scale=title_scale)
-    title_text.x = x_margin
-    title_text.y = y_start
-    main_group.append(title_text)
-    
-    # Current reading - we'll update this later
-    current_y = y_start + y_spacing
-    current_text = label.Label(
-        terminalio.FONT, 
-        text=f"Current: {current_distance:.1f} cm", 
-        scale=reading_scale
-    )
-    current_text.x = x_margin
-    current_text.y = current_y
-    main_group.append(current_text)
-    ui_elements.current_distance_label = current_text
-    
-    # Past readings section header - this never changes
-    history_y = current_y + y_spacing
-    hysteresis_y = history_y
-    history_title = label.Label(terminalio.FONT, text="Past Readings:", scale=info_scale)
-    history_title.x = x_margin
-    history_title.y = history_y
-    main_group.append(history_title)
-    
-    # Create labels for past readings
-    max_width = display_width - (2 * x_margin)
-    history_y += int(y_spacing * 0.8)
-    
-    # Create empty slots for the maximum number of past readings
-    for i in range(MAX_STORED_READINGS):
-        if i < len(past_readings):
-            reading_text = f"{i+1}: {past_readings[i]:.1f} cm"
-        else:
-            reading_text = f"{i+1}: ---.-- cm"  # Placeholder
-            
-        # Create label for this reading
-        history_text = label.Label(
-            terminalio.FONT, 
-            text=reading_text, 
-            scale=info_scale
-        )
-        
-        history_text.x = x_margin + 10
-        history_text.y = history_y + (i * int(y_spacing * 0.6))
-        
-        # Only add if it fits on screen
-        if history_text.y < display_height - y_spacing:
-            main_group.append(history_text)
-            ui_elements.past_reading_labels.append(history_text)
-    
-    # Bottom section - settings
-    settings_y = display_height - int(y_spacing * 2.5)
-    
-    # Hysteresis setting - we'll update this later
-    hysteresis_text = label.Label(
-        terminalio.FONT, 
-        text=f"Hysteresis: {hysteresis:.1f}cm", 
-        scale=info_scale
-    )
-    hysteresis_width = len(hysteresis_text.text) * 6 * info_scale
-    right_x_margin = display_width - hysteresis_width - x_margin
-    hysteresis_text.x = right_x_margin
-    hysteresis_text.y = hysteresis_y # settings_y
-    main_group.append(hysteresis_text)
-    ui_elements.hysteresis_label = hysteresis_text
-    
-    # Battery voltage
-    battery_text = label.Label(
-        terminalio.FONT, 
-        text="Battery: --.-V", 
-        scale=info_scale
-    )
-    battery_text.x = right_x_margin
-    battery_text.y = int((hysteresis_y + settings_y) / 2)
-    main_group.append(battery_text)
-    ui_elements.battery_label = battery_text
-
-    # Countdown timer - we'll update this later
-    countdown_text = label.Label(
-        terminalio.FONT, 
-        text=f"Sleep in: --s", 
-        scale=info_scale
-    )
-    # Position on right side
-    countdown_text.x = right_x_margin
-    countdown_text.y = settings_y
-    main_group.append(countdown_text)
-    ui_elements.countdown_label = countdown_text
-    
-    # Button labels - these never change
-    buttons_y = display_height - int(y_spacing * 1.0)
-    
-    # Calculate button label positions
-    button_width = int((display_width - (2 * x_margin)) / 3)
-    
-    button_labels = [
-        label.Label(terminalio.FONT, text="D0: Hyst-", scale=info_scale),
-        label.Label(terminalio.FONT, text="D1: Hyst+", scale=info_scale),
-        label.Label(terminalio.FONT, text="D2: Report", scale=info_scale)
-    ]
-    
-    for i, btn_label in enumerate(button_labels):
-        btn_label.x = x_margin + (i * button_width)
-        btn_label.y = buttons_y
-        main_group.append(btn_label)
-    
-    return ui_elements
+    return UIElements(main_group, metrics, past_readings, past_index, hysteresis)
 
 # Function to update only the current distance reading
 def update_current_distance(ui_elements, current_distance):
-    if ui_elements.current_distance_label:
-        ui_elements.current_distance_label.text = f"Current: {current_distance:.1f} cm"
+    shown = round(current_distance, 1)
+    if ui_elements.current_distance_label and shown != ui_elements.shown_distance:
+        ui_elements.shown_distance = shown
+        ui_elements.current_distance_label.text = "Current: %.1f cm" % current_distance
 
 # Function to update only the past readings
-def update_past_readings(ui_elements, past_readings):
+# past_readings is a ring buffer - walk back from the slot before past_index so the newest shows first
+# The buffer only changes by writing the newest slot and advancing past_index, so nothing needs
+# redrawing unless one of those changed (with a single slot the index never moves, so both are checked)
+def update_past_readings(ui_elements, past_readings, past_index):
+    newest = past_readings[(past_index - 1) % MAX_STORED_READINGS]
+    if past_index == ui_elements.shown_past_index and newest == ui_elements.shown_newest_past:
+        return
+    ui_elements.shown_past_index = past_index
+    ui_elements.shown_newest_past = newest
     for i, label_obj in enumerate(ui_elements.past_reading_labels):
-        if i < len(past_readings):
-            label_obj.text = f"{i+1}: {past_readings[i]:.1f} cm"
+        reading = past_readings[(past_index - 1 - i) % MAX_STORED_READINGS]
+        if reading > 0:
+            label_obj.text = "%d: %.1f cm" % (i + 1, reading)
         else:
-            label_obj.text = f"{i+1}: ---.-- cm"  # Empty slot
+            label_obj.text = "%d: ---.-- cm" % (i + 1)  # Empty slot
 
-# Function to update only the hysteresis value
+# Function to update only the hysteresis value - returns True if the label changed
 def update_hysteresis(ui_elements, hysteresis):
-    if ui_elements.hysteresis_label:
-        ui_elements.hysteresis_label.text = f"Hysteresis: {hysteresis:.1f}cm"
+    if ui_elements.hysteresis_label and hysteresis != ui_elements.shown_hysteresis:
+        ui_elements.shown_hysteresis = hysteresis
+        ui_elements.hysteresis_label.text = "Hysteresis: %.1fcm" % hysteresis
+        return True
+    return False
 
-# Function to update only the countdown timer
+# Function to update only the countdown timer - returns True if the label changed
 def update_countdown(ui_elements, seconds_remaining):
-    if ui_elements.countdown_label:
-        ui_elements.countdown_label.text = f"Sleep in: {seconds_remaining}s"
+    if ui_elements.countdown_label and seconds_remaining != ui_elements.shown_countdown:
+        ui_elements.shown_countdown = seconds_remaining
+        ui_elements.countdown_label.text = "Sleep in: " + str(seconds_remaining) + "s"
+        return True
+    return False
 
 # Function to update only the battery level
 def update_battery_label(ui_elements):
-    if ui_elements.battery_label:
-        ui_elements.battery_label.text = f"Battery: {battery_level:.2f}V"
+    shown = round(battery_level, 2)
+    if ui_elements.battery_label and shown != ui_elements.shown_battery:
+        ui_elements.shown_battery = shown
+        ui_elements.battery_label.text = "Battery: %.2fV" % battery_level
 
 
 # Function to connect to WiFi with robust error handling
 def connect_wifi():
     try:
+        # Still associated from an earlier report this wake - nothing to do
+        if wifi.radio.connected:
+            return True
+        
         print("Connecting to WiFi...")
         # Check if we have credentials
         if not WIFI_SSID or not WIFI_PASSWORD:
@@ -315,9 +355,8 @@ def connect_wifi():
             
         # Try to connect with timeout
         try:
-            # Make sure wifi is enabled
+            # Make sure wifi is enabled (synchronous - connect() below handles radio readiness)
             wifi.radio.enabled = True
-            time.sleep(1)  # Brief delay to allow radio to initialize
             
             # Check if we're in CircuitPython safe mode, which disables networking
             # Not all versions of CircuitPython expose this property
@@ -329,7 +368,15 @@ def connect_wifi():
                 # If we can't check safe mode, just continue
                 pass
                 
-            # Try connecting with timeout
+            # The radio is only up for the posts and goes off straight after, so run it without
+            # power saving for full throughput (power_management needs CircuitPython 9.1+)
+            try:
+                wifi.radio.power_management = wifi.PowerManagement.NONE
+            except AttributeError:
+                pass
+            
+            # Try connecting with timeout - free what we can first, the connect allocates large buffers
+            gc.collect()
             try:
                 wifi.radio.connect(WIFI_SSID, WIFI_PASSWORD, timeout=10)
                 print(f"Connected to {WIFI_SSID}!")
@@ -348,65 +395,111 @@ def connect_wifi():
         print(f"Unexpected WiFi error: {e}")
         return False
 
-# Function to send data to Adafruit IO with specified feed
-def send_to_adafruit_io(value, feed_name=None):
-    if feed_name is None:
-        feed_name = FEED_NAME
-        
+# Drop the HTTP session and its sockets, then turn the radio off
+def wifi_off():
+    close_session()
+    if wifi.radio.enabled:
+        wifi.radio.enabled = False
+
+# Get the radio's socket pool, shared by the clock sync and the HTTP session
+# Networking modules are imported here so wakes that never use the radio don't pay for loading them
+def get_pool():
+    global _POOL
+    if _POOL is None:
+        gc.collect()
+        import adafruit_connection_manager
+        _POOL = adafruit_connection_manager.get_radio_socketpool(wifi.radio)
+    return _POOL
+
+# Create the HTTP session once and reuse it (and its keep-alive socket/TLS state) for later posts
+def get_session():
+    global _SSL, _REQUESTS
+    if _REQUESTS is None:
+        import adafruit_connection_manager
+        import adafruit_requests
+        get_pool()
+        _SSL = None if INSECURE_HTTP else adafruit_connection_manager.get_radio_ssl_context(wifi.radio)
+        _REQUESTS = adafruit_requests.Session(_POOL, _SSL)
+    return _REQUESTS
+
+# Close the session's sockets and drop it, so the next post starts a fresh one
+def close_session():
+    global _POOL, _SSL, _REQUESTS
+    if _POOL is not None:
+        try:
+            import adafruit_connection_manager
+            adafruit_connection_manager.connection_manager_close_all(release_references=True)
+        except Exception as e:
+            print(f"Error closing HTTP session: {e}")
+        _POOL = _SSL = _REQUESTS = None
+
+# Function to POST to Adafruit IO and return just the status code
+# The response is always closed so its socket goes back to the pool; a kept-alive socket the
+# server has since dropped raises OSError, so the session is rebuilt and the post tried once more
+def post_for_status(url, raw=None, payload=None):
+    for attempt in range(2):
+        try:
+            response = get_session().post(url, headers=_HEADERS, data=raw, json=payload, timeout=15)
+        except OSError as e:
+            if attempt:
+                raise
+            print(f"Connection error ({e}) - reconnecting")
+            close_session()
+            continue
+        try:
+            return response.status_code
+        finally:
+            response.close()
+
+# Function to post a JSON payload to an Adafruit IO feed endpoint, creating the feed if it's missing
+def post_to_adafruit_io(feed_name, data, endpoint="data"):
     try:
         # Check if we have required credentials
         if not ADAFRUIT_USERNAME or not ADAFRUIT_KEY:
             print("ERROR: Adafruit IO credentials missing in settings.toml")
             return False
             
-        # Create session and make request
-        pool = socketpool.SocketPool(wifi.radio)
-        requests = adafruit_requests.Session(pool, ssl.create_default_context())
-        
-        # Construct URL and headers
-        url = f"{ADAFRUIT_AIO_URL}{ADAFRUIT_USERNAME}/feeds/{feed_name}/data"
-        headers = {
-            "X-AIO-Key": ADAFRUIT_KEY,
-            "Content-Type": "application/json"
-        }
-        
-        # Create data payload
-        data = {"value": value}
+        # Construct URL (once per feed and endpoint)
+        url = _FEED_URLS.get((feed_name, endpoint))
+        if url is None:
+            url = _FEED_URLS[(feed_name, endpoint)] = _FEEDS_URL + "/" + feed_name + "/" + endpoint
+        # A preformatted bytes body goes out as-is; anything else through the json encoder
+        if isinstance(data, bytes):
+            raw, payload = data, None
+        else:
+            raw, payload = None, data
         
         # Send the data with timeout handling
-        print(f"Posting to feed '{feed_name}': {value}")
+        print(f"Posting to feed '{feed_name}': {data}")
         print(f"URL: {url}")
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=15)
-            print(f"Response: {response.status_code}")
-            response_text = response.text
-            response.close()
+            # Only the status is needed - the body is never read into memory
+            status = post_for_status(url, raw, payload)
+            print(f"Response: {status}")
             
-            if response.status_code == 404:
+            if status == 404:
                 print(f"Feed not found! Attempting to create feed ({feed_name}) and retry...")
                 # Attempt to create the feed
-                create_feed_url = f"{ADAFRUIT_AIO_URL}{ADAFRUIT_USERNAME}/feeds"
+                create_feed_url = _FEEDS_URL
                 create_feed_data = {
                     "name": feed_name,
                     "key": feed_name,
                     "description": f"Auto-created {feed_name} feed",
                     "visibility": "public"
                 }
-                create_response = requests.post(create_feed_url, headers=headers, json=create_feed_data, timeout=15)
-                print(f"Response to create feed: {create_response.status_code}")
-                create_response.close()
+                create_status = post_for_status(create_feed_url, payload=create_feed_data)
+                print(f"Response to create feed: {create_status}")
                 
-                if create_response.status_code == 201:
+                if create_status == 201:
                     print("Feed created successfully! Retrying data post...")
-                    response = requests.post(url, headers=headers, json=data, timeout=15)
-                    print(f"Retry response: {response.status_code}")
-                    response.close()
-                    return response.status_code == 200
+                    status = post_for_status(url, raw, payload)
+                    print(f"Retry response: {status}")
+                    return status == 200
                 else:
                     print(f"Failed to create feed")
                     return False
             
-            return response.status_code == 200
+            return status == 200
         except Exception as e:
             print(f"Failed to post to Adafruit IO: {e}")
             return False
@@ -415,8 +508,113 @@ def send_to_adafruit_io(value, feed_name=None):
         return False
 
 
-# Initialize the I2C bus
-i2c = busio.I2C(board.SCL, board.SDA)
+# Function to send data to Adafruit IO with specified feed
+def send_to_adafruit_io(value, feed_name=None):
+    if feed_name is None:
+        feed_name = FEED_NAME
+    # A single number is formatted into the JSON body directly instead of building a dict to encode;
+    # anything else (e.g. a message) goes through the json encoder so it's quoted and escaped
+    if isinstance(value, (int, float)):
+        return post_to_adafruit_io(feed_name, ('{"value":%s}' % value).encode())
+    return post_to_adafruit_io(feed_name, {"value": value})
+
+# Function to send several queued data points to a feed in a single batch request
+def send_batch_to_adafruit_io(points, feed_name=None):
+    if feed_name is None:
+        feed_name = FEED_NAME
+    if not points:
+        return True
+    return post_to_adafruit_io(feed_name, {"data": points}, "data/batch")
+
+# Function to send one value per feed to the Adafruit IO group in a single request
+# values maps feed key to value - feeds with a None value are left out
+def send_group_to_adafruit_io(values, created_at=None):
+    feeds = [{"key": key, "value": value} for key, value in values.items() if value is not None]
+    if not feeds:
+        return True
+    data = {"feeds": feeds}
+    if created_at:
+        data["created_at"] = created_at
+    try:
+        if not ADAFRUIT_USERNAME or not ADAFRUIT_KEY:
+            print("ERROR: Adafruit IO credentials missing in settings.toml")
+            return False
+        
+        print(f"Posting to group '{GROUP_NAME}': {data}")
+        status = post_for_status(_GROUP_DATA_URL, payload=data)
+        print(f"Response: {status}")
+        
+        if status == 404:
+            print(f"Group not found! Attempting to create group ({GROUP_NAME}) and retry...")
+            create_status = post_for_status(_GROUPS_URL, payload={"name": GROUP_NAME, "key": GROUP_NAME})
+            print(f"Response to create group: {create_status}")
+            if create_status != 201:
+                print("Failed to create group")
+                return False
+            print("Group created successfully! Retrying data post...")
+            status = post_for_status(_GROUP_DATA_URL, payload=data)
+            print(f"Retry response: {status}")
+        
+        return status == 200
+    except Exception as e:
+        print(f"Failed to post to Adafruit IO group: {e}")
+        return False
+
+# The RTC starts at 2000 after a cold boot, so any earlier year means it hasn't been set yet
+def clock_is_set():
+    return time.localtime().tm_year >= 2024
+
+# Set the RTC over NTP on the shared socket pool, if it isn't set already
+# (it keeps running through deep sleep, so this is normally only needed after a cold boot)
+def sync_clock():
+    if clock_is_set():
+        return True
+    try:
+        pool = get_pool()
+        packet = bytearray(48)
+        packet[0] = 0x1B  # client request, NTP version 3
+        address = pool.getaddrinfo(NTP_SERVER, 123)[0][4]
+        sock = pool.socket(pool.AF_INET, pool.SOCK_DGRAM)
+        try:
+            sock.settimeout(5)
+            sock.sendto(packet, address)
+            sock.recv_into(packet)
+        finally:
+            sock.close()
+        # Transmit timestamp seconds sit at byte 40 of the reply
+        seconds = struct.unpack_from(">I", packet, 40)[0] - NTP_TO_UNIX_SECONDS
+        _RTC.datetime = time.localtime(seconds)
+        print("Clock set over NTP")
+        return True
+    except Exception as e:
+        print(f"Could not set the clock: {e}")
+        return False
+
+# Add the current time to a data point that doesn't have one yet - left alone if the clock isn't set
+def stamp_data_point(point):
+    if "created_at" in point or not clock_is_set():
+        return
+    now = time.localtime()
+    point["created_at"] = "%04d-%02d-%02dT%02d:%02d:%02dZ" % (
+        now.tm_year, now.tm_mon, now.tm_mday, now.tm_hour, now.tm_min, now.tm_sec)
+
+# Build a data point for the batch endpoint - only timestamped if the clock has been set,
+# otherwise Adafruit IO stamps it on arrival (so such points are uploaded straight away)
+def make_data_point(value):
+    point = {"value": value}
+    stamp_data_point(point)
+    return point
+
+# Queue an error message for the error feed - it's uploaded with the next batch of readings
+def queue_error(message):
+    global pending_errors
+    print(f"Queued error report: {message}")
+    pending_errors.append(make_data_point(message))
+    pending_errors = pending_errors[-MAX_PENDING_POINTS:]
+
+
+# Initialize the I2C bus in 400kHz Fast-mode - the VL53L0X/VL53L1X and MAX17048 all support it
+i2c = busio.I2C(board.SCL, board.SDA, frequency=400_000)
 
 
 sensor = None
@@ -427,7 +625,8 @@ try:
     # Try VL53L0X first
     import adafruit_vl53l0x
     sensor = adafruit_vl53l0x.VL53L0X(i2c)
-    sensor.measurement_timing_budget = 200000  # 200ms
+    # 100ms per measurement by default - the median over several samples makes up for the extra noise
+    sensor.measurement_timing_budget = SENSOR_TIMING_BUDGET_MS * 1000  # in microseconds
     sensor_type = "VL53L0X"
     print("VL53L0X sensor initialized")
 except Exception as e:
@@ -438,7 +637,7 @@ except Exception as e:
         sensor = adafruit_vl53l1x.VL53L1X(i2c)
         # VL53L1X uses different configuration methods
         sensor.distance_mode = 2  # Long range mode
-        sensor.timing_budget = 200  # 400ms
+        sensor.timing_budget = SENSOR_TIMING_BUDGET_MS  # must be 15, 20, 33, 50, 100, 200 or 500ms
         sensor_type = "VL53L1X"
         sensor_out_of_range = 800  # Higher range for VL53L1X
         print("VL53L1X sensor initialized")
@@ -447,6 +646,83 @@ except Exception as e:
         print("No supported distance sensor found!")
         raise
 
+# supervisor.ticks_ms() counts in whole milliseconds (no float precision loss over a long
+# uptime) and wraps at 2**29, so deadlines are compared through ticks_diff
+_TICKS_PERIOD = 1 << 29
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+# Milliseconds from start to end, correct across a ticks_ms wrap (negative once end has passed)
+def ticks_diff(end, start):
+    diff = (end - start) & _TICKS_MAX
+    return ((diff + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+# Take one VL53L0X sample - returns the distance in cm, or None if it should be skipped
+def sample_vl53l0x(deadline):
+    # VL53L0X reports in mm, convert to cm
+    # In continuous mode this blocks until the next measurement is ready
+    raw_range = sensor.range
+    
+    # Check if out of range or error
+    if raw_range >= sensor_out_of_range * 10:  # Check in mm
+        print(f"VL53L0X out of range: {raw_range/10:.1f}cm")
+        return None
+    
+    # Convert to cm
+    return raw_range / 10
+
+# Take one VL53L1X sample - returns the distance in cm, or None if it should be skipped
+def sample_vl53l1x(deadline):
+    # Wait for the next measurement, no longer than the overall deadline
+    while not sensor.data_ready and ticks_diff(deadline, supervisor.ticks_ms()) > 0:
+        time.sleep(0.005)
+    
+    # Check if data is ready
+    if not sensor.data_ready:
+        print("VL53L1X data not ready")
+        return None
+    
+    # Get distance (already in cm, None if no target)
+    raw_range = sensor.distance
+    
+    # Clear interrupt to arm the next measurement
+    sensor.clear_interrupt()
+    
+    # # Check range status
+    # if sensor.status != 0:
+    #     print(f"VL53L1X status error: {sensor.status}")
+    #     return None
+        
+    # Check if out of range
+    if raw_range is None or raw_range >= sensor_out_of_range:  # Check in cm
+        print(f"VL53L1X out of range: {raw_range}cm")
+        return None
+    
+    return raw_range
+
+# Pick the sampling functions for the detected sensor once, rather than checking the type per sample
+if sensor_type == "VL53L0X":
+    sample_once, _start_ranging, _stop_ranging = sample_vl53l0x, sensor.start_continuous, sensor.stop_continuous
+else:
+    sample_once, _start_ranging, _stop_ranging = sample_vl53l1x, sensor.start_ranging, sensor.stop_ranging
+
+# Ranging only runs for the length of a read_distance batch, so the sensor isn't drawing
+# current through the upload or the awake window - the flag tracks whether it's running,
+# so the extra stop before deep sleep stays off the I2C bus
+sensor_ranging = False
+
+def start_sampling():
+    global sensor_ranging
+    if not sensor_ranging:
+        _start_ranging()
+        sensor_ranging = True
+
+def stop_sampling():
+    global sensor_ranging
+    if sensor_ranging:
+        _stop_ranging()
+        sensor_ranging = False
+
 battery_sensor = None
 battery_level = 0.0
 try:
@@ -474,120 +750,167 @@ try:
         raise
 except Exception as e:
     print(f"Battery sensor initialization failed: {e}")
+    import traceback  # only loaded when there's an error to print
     traceback.print_exception(e)
     battery_sensor = None
 
+# Take one battery reading, leaving the gauge hibernated between reads
+# Returns the voltage (also kept in battery_level for the label), or None if there's no reading
+def read_battery_voltage():
+    global battery_level
+    if battery_sensor is None:
+        return None
+    try:
+        if battery_sensor.hibernating:
+            battery_sensor.wake()
+            time.sleep(0.05)
+        battery_level = battery_sensor.cell_voltage
+        battery_sensor.hibernate()
+        print(f"Battery voltage: {battery_level:.2f}V")
+        return battery_level
+    except Exception as e:
+        print(f"Error reading battery voltage: {e}")
+        return None
+
 
 # Global variables to track time and last readings
 last_report_time = 0
 last_distance = 0
-past_readings = []
+last_reported_distance = 0  # reading most recently queued for upload - changes are measured from it
+# Fixed-size ring buffer of previous readings - past_index is the next slot to write, 0.0 marks an empty slot
+past_readings = [0.0] * MAX_STORED_READINGS
+past_index = 0
+pending_readings = []  # readings waiting to be uploaded as a batch
+pending_errors = []  # error messages waiting to be uploaded to the error feed
 hysteresis = DEFAULT_HYSTERESIS  # Default hysteresis value from settings.toml
 
 # Initialize display
 display, main_group, backlight = setup_display()
+BLANK_GROUP = displayio.Group()  # shown before deep sleep, so clearing the screen doesn't allocate
+
+# Display layout - none of it depends on runtime state, so it's worked out once here
+DISPLAY_WIDTH = getattr(display, "width", 320)
+DISPLAY_HEIGHT = getattr(display, "height", 240)
+TITLE_SCALE = 2 if DISPLAY_WIDTH >= 240 else 1
+READING_SCALE = 2 if DISPLAY_WIDTH >= 240 else 1
+INFO_SCALE = 1
+X_MARGIN = int(DISPLAY_WIDTH * 0.05)  # 5% margin
+Y_START = int(DISPLAY_HEIGHT * 0.1)   # Start 10% from top
+Y_SPACING = int(DISPLAY_HEIGHT * 0.13)  # Spacing is 13% of height
+# y of each past reading label, dropping any that would run off the bottom of the screen
+HISTORY_Y = tuple(
+    y for y in (Y_START + 2 * Y_SPACING + int(Y_SPACING * 0.8) + i * int(Y_SPACING * 0.6)
+                for i in range(MAX_STORED_READINGS))
+    if y < DISPLAY_HEIGHT - Y_SPACING
+)
+SETTINGS_Y = DISPLAY_HEIGHT - int(Y_SPACING * 2.5)
+BUTTONS_Y = DISPLAY_HEIGHT - Y_SPACING
+BUTTON_WIDTH = int((DISPLAY_WIDTH - (2 * X_MARGIN)) / 3)
+BUTTON_LEGENDS = ("D0: Hyst-", "D1: Hyst+", "D2: Report")
+DISPLAY_METRICS = (DISPLAY_WIDTH, DISPLAY_HEIGHT, X_MARGIN, Y_START, Y_SPACING,
+                   TITLE_SCALE, READING_SCALE, INFO_SCALE)
+ui_elements = None  # built by build_display_interface at the start of main()
 
 # Initialize buttons
-buttons = setup_buttons()
+button_pins, button_dios, button_pressed = setup_buttons()
+
+# Pin alarms for the buttons, built once and used both for light sleep during the awake window
+# and for deep sleep - lined up with button_pins, None where an alarm couldn't be made
+BUTTON_ALARMS = []
+for pin, pressed in zip(button_pins, button_pressed):
+    try:
+        BUTTON_ALARMS.append(alarm.pin.PinAlarm(pin=pin, value=pressed, pull=True))
+    except Exception as e:
+        print(f"Error setting up button alarm for {pin}: {e}")
+        BUTTON_ALARMS.append(None)
+BUTTON_ALARMS = tuple(BUTTON_ALARMS)
+
+# Valid samples for one reading, allocated once and refilled from the start on every call
+SAMPLE_BUFFER = array.array("f", [0.0] * SENSOR_SAMPLES)
+
+# Partially order buf[lo..hi] in place so buf[k] holds the value a full sort would put there
+# (quickselect with Hoare partitioning - no sorted copy of the samples is made)
+def nth_element(buf, k, lo, hi):
+    while lo < hi:
+        pivot = buf[(lo + hi) // 2]
+        i, j = lo, hi
+        while i <= j:
+            while buf[i] < pivot:
+                i += 1
+            while buf[j] > pivot:
+                j -= 1
+            if i <= j:
+                buf[i], buf[j] = buf[j], buf[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            return
+
 # Read distance with improved error handling and modal sampling
 def read_distance():
     try:
         # Measure distance multiple times and use modal value for reliability
-        readings = []
-        valid_readings = []
-        samples = 10  # Take more samples for better modal analysis
+        # Valid samples go into the fixed buffer; questionable ones only feed a running sum
+        buf = SAMPLE_BUFFER
+        n_valid = 0
+        n_readings = 0
+        sum_readings = 0.0
+        samples = SENSOR_SAMPLES  # The median rejects bad samples (up to two of the default 5)
+        
+        # Keep the sensor ranging for the whole batch rather than starting it per sample,
+        # and never wait longer than a few timing budgets overall
+        deadline = (supervisor.ticks_ms() + samples * SENSOR_TIMING_BUDGET_MS * 5) & _TICKS_MAX
+        start_sampling()
         
         for _ in range(samples):
+            if ticks_diff(deadline, supervisor.ticks_ms()) <= 0:
+                print("Sensor sampling timed out")
+                break
             try:
-                # Read sensor based on type with appropriate error checks
-                if sensor_type == "VL53L0X":
-                    # VL53L0X reports in mm, convert to cm
-                    raw_range = sensor.range
-                    
-                    # Check if out of range or error
-                    if raw_range >= sensor_out_of_range * 10:  # Check in mm
-                        print(f"VL53L0X out of range: {raw_range/10:.1f}cm")
-                        continue
-                    
-                    # Convert to cm
-                    reading = raw_range / 10
-                    
-                elif sensor_type == "VL53L1X":
-                    # Start measurement if needed (VL53L1X needs explicit start)
-                    if not sensor.data_ready:
-                        sensor.start_ranging()
-                        # Wait for data to be ready
-                        for _ in range(10):  # Try up to 10 times
-                            time.sleep(0.01)
-                            if sensor.data_ready:
-                                break
-                    
-                    # Check if data is ready
-                    if not sensor.data_ready:
-                        print("VL53L1X data not ready")
-                        continue
-                    
-                    # Get distance (already in cm)
-                    raw_range = sensor.distance
-                    
-                    # # Check range status
-                    # if sensor.status != 0:
-                    #     print(f"VL53L1X status error: {sensor.status}")
-                    #     continue
-                        
-                    # Check if out of range
-                    if raw_range >= sensor_out_of_range * 10:  # Check in mm
-                        print(f"VL53L1X out of range: {raw_range/10:.1f}cm")
-                        continue
-                    
-                    # Clear ranging to prepare for next sample
-                    sensor.clear_interrupt()
-                    
-                else:
-                    print("Unknown sensor type")
-                    return -1
+                reading = sample_once(deadline)
+                if reading is None:
+                    continue
                 
                 # Add to all readings
-                readings.append(reading)
+                n_readings += 1
+                sum_readings += reading
                 
                 # Check for valid readings (reasonable range for oil tanks)
-                if reading is not None and 5 < int(reading) < sensor_out_of_range:  # Between 5cm and out_of_range
-                    valid_readings.append(reading)
+                if 5 < int(reading) < sensor_out_of_range:  # Between 5cm and out_of_range
+                    buf[n_valid] = reading
+                    n_valid += 1
                 else:
                     print(f"Ignored questionable reading: {reading:.1f}cm")
                     
             except Exception as e:
                 print(f"Error reading sensor: {e}")
-                traceback.print_exception(e)
-
-            
-            time.sleep(0.1)
+        
+        # Stop ranging between batches to save power
+        stop_sampling()
         
         # If we have valid readings, find the middle element
         avg_reading = -1  # Default to -1 if no valid readings
-        if valid_readings:
-            # Round readings to 1 decimal place for finding mode
-            rounded_readings = [round(r, 1) for r in valid_readings]
-            
-            #return middle value
-            sorted_readings = sorted(rounded_readings)
-            mid_index = len(sorted_readings) // 2
-            avg_reading = sorted_readings[mid_index]
+        if n_valid:
+            #return middle value, rounded to 1 decimal place as it's stored
+            mid = n_valid // 2
+            nth_element(buf, mid, 0, n_valid - 1)
+            avg_reading = round(buf[mid], 1)
 
             print(f"Valid reading: {avg_reading:.1f}cm")
 
             return avg_reading
         
         # If no valid readings but we have some readings, average them as fallback
-        elif readings:
-            avg_reading = sum(readings) / len(readings)
+        elif n_readings:
+            avg_reading = sum_readings / n_readings
             print(f"WARNING: Using average of questionable readings: {avg_reading:.1f}cm")
             
             # Report error to error feed
-            if wifi.radio.connected:
-                error_msg = f"Using avg of {len(readings)} questionable readings: {avg_reading:.1f}cm"
-                if not send_to_adafruit_io(error_msg, ERROR_FEED_NAME):
-                    print(f"Failed to report error: {error_msg}")
+            queue_error(f"Using avg of {n_readings} questionable readings: {avg_reading:.1f}cm")
                 
             return avg_reading
         
@@ -595,8 +918,7 @@ def read_distance():
             print("ERROR: No distance readings obtained")
             
             # Report error to error feed
-            if wifi.radio.connected:
-                send_to_adafruit_io("No distance readings obtained", ERROR_FEED_NAME)
+            queue_error("No distance readings obtained")
                 
             return -1
             
@@ -604,8 +926,7 @@ def read_distance():
         print(f"Unexpected error in read_distance: {e}")
         
         # Report error to error feed
-        if wifi.radio.connected:
-            send_to_adafruit_io(f"Sensor error: {str(e)}", ERROR_FEED_NAME)
+        queue_error(f"Sensor error: {str(e)}")
             
         return -1
 
@@ -624,32 +945,213 @@ elif supervisor.runtime.run_reason is supervisor.RunReason.STARTUP:
     print("First boot, initializing...")
     last_report_time = 0
     last_distance = 0
-    past_readings = []
-time.sleep(2) # debug
+    last_reported_distance = 0
+    past_readings = [0.0] * MAX_STORED_READINGS
+    past_index = 0
     
-# Try to load previous state from a file
+# Hot state is kept as a fixed-layout struct: magic, history length, flags, wakes until the next flash write,
+# steady wake count, last report time, last distance, last reported distance, hysteresis, ring buffer index, past readings
+# (the readings as uint16 tenths of a cm, 2 bytes each instead of a 4-byte float).
+# Between deep sleeps it lives in alarm.sleep_memory, and is copied to microcontroller.nvm
+# every few wakes (boards without NVM write the same packed record to state.bin instead).
+# state.json only holds queued uploads (they don't fit a fixed layout), and is read once
+# to migrate the hot state from older versions that kept everything there
+STATE_MAGIC = 0x0A1D
+STATE_FORMAT = "<HBBBBffffB" + "H" * MAX_STORED_READINGS
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+STATE_FLAG_PENDING = 0x01  # queued uploads are waiting in state.json
+PERSIST_EVERY_WAKES = 8  # copy the state to flash at least this often (daily at the default interval)
+wakes_until_persist = 0
+MAX_STABLE_CYCLES = 7  # cap on how far a steady level stretches the check interval (x8)
+stable_cycles = 0  # consecutive checks where the level stayed well inside the hysteresis
+
+# Unpack a saved state record into the globals - returns the flags, or None if it isn't valid
+def unpack_state(data):
+    global last_report_time, last_distance, last_reported_distance, hysteresis, past_readings, past_index, wakes_until_persist, stable_cycles
+    if len(data) < STATE_SIZE:
+        return None
+    fields = struct.unpack(STATE_FORMAT, data[0:STATE_SIZE])
+    # A record saved with a different history length (or a ring index outside it) doesn't fit
+    # the ring buffer - reject it before touching the globals
+    if fields[0] != STATE_MAGIC or fields[1] != MAX_STORED_READINGS or fields[9] >= MAX_STORED_READINGS:
+        return None
+    (flags, wakes_until_persist, stable_cycles, last_report_time, last_distance,
+     last_reported_distance, hysteresis, past_index) = fields[2:10]
+    past_readings = [tenths / 10 for tenths in fields[10:]]
+    return flags
+
+# Pack the hot state into a record for sleep memory, NVM or state.bin
+def pack_state(flags):
+    return struct.pack(STATE_FORMAT, STATE_MAGIC, MAX_STORED_READINGS, flags, wakes_until_persist, stable_cycles,
+                       last_report_time, last_distance, last_reported_distance, hysteresis, past_index,
+                       *[min(int(reading * 10 + 0.5), 0xFFFF) for reading in past_readings])
+
+# Load the hot state from sleep memory - only valid when waking from deep sleep
+def load_state_from_sleep_memory():
+    if alarm.wake_alarm is None or len(alarm.sleep_memory) < STATE_SIZE:
+        return None
+    return unpack_state(alarm.sleep_memory[0:STATE_SIZE])
+
+# Save the hot state to sleep memory - returns False if there isn't room for it
+def save_state_to_sleep_memory(flags):
+    if len(alarm.sleep_memory) < STATE_SIZE:
+        return False
+    alarm.sleep_memory[0:STATE_SIZE] = pack_state(flags)
+    return True
+
+# Load the hot state from NVM - returns the flags, or None if there's no valid state there
+def load_state_from_nvm():
+    nvm = microcontroller.nvm
+    if nvm is None or len(nvm) < STATE_SIZE:
+        return None
+    return unpack_state(nvm[0:STATE_SIZE])
+
+# Save the hot state to NVM - returns False if this board has no NVM to use
+def save_state_to_nvm(flags):
+    nvm = microcontroller.nvm
+    if nvm is None or len(nvm) < STATE_SIZE:
+        return False
+    # Skip the flash write if the stored record is already identical
+    record = pack_state(flags)
+    if nvm[0:STATE_SIZE] != record:
+        nvm[0:STATE_SIZE] = record
+    return True
+
+# Load the hot state from state.bin - returns the flags, or None if the file is missing or invalid
+def load_state_from_file():
+    try:
+        with open("state.bin", "rb") as f:
+            return unpack_state(f.read())
+    except OSError:
+        return None
+
+# Write a state file via a temporary copy, so a reset part way through the write
+# can't leave a truncated file behind (FAT can't rename over an existing file, so it's removed first)
+def write_file_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    os.rename(temp_path, path)
+
+# Save the hot state to state.bin, for boards without NVM
+def save_state_to_file(flags):
+    write_file_atomic("state.bin", pack_state(flags))
+
+# Try to load previous state from sleep memory, then NVM, then state.bin
+state_flags = None
 try:
-    with open("state.json", "r") as f:
-        state = json.load(f)
-        last_report_time = state["last_report_time"]
-        last_distance = state["last_distance"]
-        past_readings = state.get("past_readings", [])
-        hysteresis = state.get("hysteresis", DEFAULT_HYSTERESIS)
+    state_flags = load_state_from_sleep_memory()
+    if state_flags is None:
+        state_flags = load_state_from_nvm()
+    if state_flags is None:
+        state_flags = load_state_from_file()
+    if state_flags is not None:
         print(f"Loaded state: last report at {last_report_time}, distance: {last_distance}cm")
         print(f"Hysteresis: {hysteresis}cm")
-except (OSError, ValueError):
-    print("No valid state file found, starting fresh")
-    last_report_time = 0
-    last_distance = 0
-    past_readings = []
+except Exception as e:
+    print(f"Error loading saved state: {e}")
+
+# Read state.json if uploads are queued in it, or to migrate an older state file
+saved_pending = None  # the queues as last written to state.json, to skip rewriting them unchanged
+state_file_found = False  # state.json exists, so it's removed once the queues have drained
+if state_flags is None or state_flags & STATE_FLAG_PENDING:
+    try:
+        # json is only needed for the queued uploads, so it's only loaded when there are some
+        import json
+        with open("state.json", "r") as f:
+            state_file_found = True
+            state = json.load(f)
+            if state_flags is None:
+                last_report_time = state["last_report_time"]
+                last_distance = state["last_distance"]
+                last_reported_distance = last_distance
+                past_readings = state.get("past_readings", [])
+                if "past_index" not in state:
+                    # Older newest-first list - lay it out oldest to newest from slot 0, so the
+                    # ring walks back from the slot before past_index through the newest first
+                    newest_first = past_readings[:MAX_STORED_READINGS]
+                    past_readings = [float(reading) for reading in reversed(newest_first)]
+                    past_readings += [0.0] * (MAX_STORED_READINGS - len(past_readings))
+                    past_index = len(newest_first) % MAX_STORED_READINGS
+                else:
+                    past_index = state["past_index"]
+                    if len(past_readings) != MAX_STORED_READINGS or not 0 <= past_index < MAX_STORED_READINGS:
+                        # Ring saved with a different size - start it over
+                        past_readings = [0.0] * MAX_STORED_READINGS
+                        past_index = 0
+                hysteresis = state.get("hysteresis", DEFAULT_HYSTERESIS)
+                print(f"Loaded state: last report at {last_report_time}, distance: {last_distance}cm")
+                print(f"Hysteresis: {hysteresis}cm")
+            # Only take the queues once the whole record has parsed
+            pending_readings = state.get("pending_readings", [])
+            pending_errors = state.get("pending_errors", [])
+            saved_pending = (list(pending_readings), list(pending_errors))
+    except (OSError, ValueError, KeyError):
+        # A file that doesn't parse as a whole is dropped with its queues (they're left empty
+        # and the file is removed when state is saved), rather than resending stale uploads
+        if state_file_found:
+            print("Discarding unreadable state.json")
+        if state_flags is None:
+            print("No valid state file found, starting fresh")
+            last_report_time = 0
+            last_distance = 0
+            last_reported_distance = 0
+            past_readings = [0.0] * MAX_STORED_READINGS
+            past_index = 0
+
+# Change the CPU clock where the port allows it - returns the previous frequency, or None if it can't be set
+def set_cpu_frequency(frequency):
+    try:
+        previous = microcontroller.cpu.frequency
+        microcontroller.cpu.frequency = frequency
+        return previous
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+# Shut everything down that could keep drawing current through deep sleep
+def prep_deep_sleep():
+    # Radio fully off - leaving it initialised keeps its rails powered in deep sleep
+    wifi_off()
+    
+    # Clear the display and turn the backlight off
+    display.root_group = BLANK_GROUP
+    display.auto_refresh = True
+    if backlight:
+        backlight.value = False
+    
+    # Make sure the sensor isn't left ranging, then release the bus
+    try:
+        stop_sampling()
+        i2c.deinit()
+    except Exception as e:
+        print(f"Error shutting down I2C: {e}")
 
 def main():
-    global last_report_time, last_distance, past_readings, hysteresis
+    global last_report_time, last_distance, last_reported_distance, past_readings, past_index, hysteresis, pending_readings, pending_errors, ui_elements, wakes_until_persist, stable_cycles
+    
+    # Put the interface up before sampling, so the screen isn't blank while the sensor runs
+    # (timer wakes wait until they know there's something worth showing)
+    if wake_reason != "timer":
+        ui_elements = build_display_interface(main_group, DISPLAY_METRICS, past_readings, past_index, hysteresis)
+        display.refresh()
     
     current_time = time.monotonic()
+    time_since_last_report = current_time - last_report_time
+    
+    # A button wake shortly after a report is for interaction - show the last reading straight
+    # away instead of sampling first; D2 takes a fresh reading if a report is actually wanted
+    skip_read = wake_reason == "button" and last_distance > 0 and time_since_last_report < REPORT_INTERVAL / 4
     
     # Read current distance with error handling
-    current_distance = read_distance()
+    if skip_read:
+        print("Button wake - showing last reading without sampling")
+        current_distance = last_distance
+    else:
+        current_distance = read_distance()
     if current_distance < 0:
         print("ERROR: Could not get valid distance reading")
         # Try to use last known good reading if available
@@ -662,61 +1164,126 @@ def main():
     
     print(f"Current distance: {current_distance:.1f}cm")
     
-    # Update past readings - only store valid readings
-    if last_distance > 0:  # Only add non-error readings to history
-        past_readings.insert(0, last_distance)
-        # Keep only the last MAX_STORED_READINGS
-        past_readings = past_readings[:MAX_STORED_READINGS]
+    # Update past readings - only store valid readings, and not the same one again on a skipped read
+    if last_distance > 0 and not skip_read:  # Only add non-error readings to history
+        # Overwrite the oldest slot in place - no list shifting or slicing
+        past_readings[past_index] = last_distance
+        past_index = (past_index + 1) % MAX_STORED_READINGS
     
     # Determine if we need to report based on criteria
-    time_since_last_report = current_time - last_report_time
-    distance_change = abs(current_distance - last_distance) if last_distance > 0 else 0
-    
+    # Timer wakes every REPORT_INTERVAL only check the level - the radio is only used
+    # when it has moved past the hysteresis or the daily keepalive is due.
+    # Cheapest checks first, so the distance arithmetic only runs when neither applies
+    # Changes are measured from the last reported reading, so a slow drift still gets reported
+    # once it adds up - until something has been reported, from the previous reading instead
+    reference_distance = last_reported_distance if last_reported_distance > 0 else last_distance
     should_report = (
-        (time_since_last_report >= REPORT_INTERVAL) or  # Report every 3 hours
+        (wake_reason == "button" and not skip_read) or  # Report if woken by button
         (time_since_last_report >= MIN_REPORT_INTERVAL) or  # Report at least daily
-        (distance_change >= hysteresis and distance_change > 0) or  # Report on significant change
-        (wake_reason == "button")  # Report if woken by button
+        (reference_distance > 0 and abs(current_distance - reference_distance) >= hysteresis)  # Report on significant change
     )
     
-    # Set up the display ONCE (not repeatedly)
-    ui_elements = setup_display_interface(main_group, current_distance, past_readings, hysteresis)
+    # Adapt the check interval to how the level is behaving: each steady check (well inside
+    # the hysteresis) stretches it, and a real change shortens it until things settle
+    level_moving = False
+    if last_distance > 0 and not skip_read:
+        distance_change = abs(current_distance - last_distance)
+        if distance_change >= hysteresis:
+            level_moving = True
+            stable_cycles = 0
+        elif distance_change < hysteresis / 2:
+            stable_cycles = min(stable_cycles + 1, MAX_STABLE_CYCLES)
+    
+    # Queue the reading if it needs reporting - it's uploaded once enough have built up
+    if should_report:
+        pending_readings.append(make_data_point(current_distance))
+        pending_readings = pending_readings[-MAX_PENDING_POINTS:]
+        last_reported_distance = current_distance
+    
+    upload_due = pending_readings and (
+        (len(pending_readings) >= REPORT_BATCH_SIZE) or  # Enough readings queued
+        (time_since_last_report >= MIN_REPORT_INTERVAL) or  # Upload at least daily
+        (wake_reason == "button" and not skip_read) or  # Upload if woken by button
+        ("created_at" not in pending_readings[-1])  # No timestamp yet - arrival time has to stand in
+    )
+    
+    # A timer wake with nothing to report or upload (and no button held) goes straight back
+    # to sleep - no screen, no backlight and no awake window
+    quiet_wake = (
+        wake_reason == "timer" and not should_report and not upload_due and
+        not any(dio is not None and dio.value == pressed for dio, pressed in zip(button_dios, button_pressed))
+    )
+    if quiet_wake:
+        print("No change - going straight back to sleep")
+        if backlight:
+            backlight.value = False
+    else:
+        # Fill in the reading (and the history, if it moved on), building the labels if this is a timer wake
+        if ui_elements is None:
+            ui_elements = build_display_interface(main_group, DISPLAY_METRICS, past_readings, past_index, hysteresis)
+        ui_elements.update(current_distance, past_readings, past_index, hysteresis)
+        display.refresh()
     
     # Report data if needed
+    # Note: wifi.radio.connect and the HTTPS post block inside CircuitPython's C code, so running
+    # them as asyncio tasks wouldn't overlap anything - instead the display is already drawn above
+    # (displayio keeps refreshing in the background) and the awake countdown only starts afterwards
     report_success = False
-    if should_report:
+    if upload_due:
+        # Show what we're doing while the network calls block
+        if ui_elements.countdown_label:
+            ui_elements.countdown_label.text = "Uploading..."
+            ui_elements.shown_countdown = None
+            display.refresh()
 
         # Connect to WiFi with error handling
         wifi_connected = connect_wifi()
         
         if wifi_connected:
-            # Report to Adafruit IO
-            report_success = send_to_adafruit_io(current_distance)
+            # Set the clock if it isn't yet, and stamp this wake's reading now it can be
+            sync_clock()
+            if should_report:
+                stamp_data_point(pending_readings[-1])
             
-            if report_success:
-                # Update last reported values only on successful report
-                last_report_time = current_time
-            
-            # TODO: fetch fresh reading? for now just get battery
-            if battery_sensor:
-                try:
-                    if battery_sensor.hibernating:
-                        print("Waking up battery sensor")
-                        battery_sensor.wake()
-                    time.sleep(0.1)
-                    battery_level = battery_sensor.cell_voltage
-                    print(f"Battery voltage: {battery_level:.2f}V")
-                    battery_sensor.hibernate()  # Hibernate after reading
-                    print(f"Reported battery success: {(send_to_adafruit_io(battery_level, FEED_NAME + "-bat"))}")
-                    # Update battery label on display
-                    update_battery_label(ui_elements)
-                except Exception as e:
-                    print(f"Error reading+posting battery voltage: {e}")
+            # Read the battery just before posting, so its voltage can go out with the readings
+            battery_voltage = read_battery_voltage()
+            if battery_voltage is not None and ui_elements is not None:
+                update_battery_label(ui_elements)
             
-            # Disconnect WiFi to save power
-            wifi.radio.enabled = False
+            if GROUP_NAME and len(pending_readings) == 1 and len(pending_errors) <= 1:
+                # A single reading (and at most one error) - send it with the battery voltage
+                # as one group post instead of a request per feed
+                point = pending_readings[0]
+                report_success = send_group_to_adafruit_io({
+                    FEED_NAME: point["value"],
+                    BATTERY_FEED_NAME: battery_voltage,
+                    ERROR_FEED_NAME: pending_errors[0]["value"] if pending_errors else None,
+                }, point.get("created_at"))
+                if report_success:
+                    last_report_time = current_time
+                    pending_readings = []
+                    pending_errors = []
+            else:
+                # Report all queued readings to Adafruit IO in one request
+                report_success = send_batch_to_adafruit_io(pending_readings)
+                
+                if report_success:
+                    # Update last reported values only on successful report
+                    last_report_time = current_time
+                    pending_readings = []
+                
+                # Flush any queued errors while we're connected
+                if pending_errors and send_batch_to_adafruit_io(pending_errors, ERROR_FEED_NAME):
+                    pending_errors = []
+                
+                if battery_voltage is not None:
+                    battery_success = send_to_adafruit_io(battery_voltage, BATTERY_FEED_NAME)
+                    print(f"Reported battery success: {battery_success}")
         else:
             print("ERROR: Could not connect to WiFi - skipping data upload")
+        
+        # Radio off as soon as the posts are done - it isn't kept up through the awake window
+        wifi_off()
     
     # Update the last distance - only store valid readings
     if current_distance > 0:
@@ -724,95 +1291,198 @@ def main():
     
     # Handle button interaction and display for AWAKE_TIME seconds
     start_time = time.monotonic()
-    stay_awake = True
+    stay_awake = not quiet_wake
+    
+    # Hand the buttons over to pin alarms for the awake window, so the CPU can light sleep
+    # between countdown ticks instead of polling the pins every 100ms
+    for i in range(len(button_dios)):
+        if button_dios[i] is not None:
+            button_dios[i].deinit()
+            button_dios[i] = None
+    
+    # Debounce without blocking: after a press that button is disarmed (left out of the
+    # light sleep alarms) until armed_at[i], while the countdown and other buttons carry on
+    armed_at = [0.0] * len(button_pins)
     
-    # Main interaction loop - now with targeted updates instead of full rebuilds
+    # The awake window is mostly idle, so run it at 80MHz (restored for WiFi and before sleep)
+    # A quiet wake has no awake window, so it keeps the clock as it is
+    full_frequency = set_cpu_frequency(80_000_000) if stay_awake else None
+    
+    # Unpack the button pins once rather than indexing on every wake
+    pin_d0, pin_d1, pin_d2 = button_pins
+    
+    # Main interaction loop - wakes once a second for the countdown, or on a button press
+    # dirty is set when a button changes a label, so the display is only refreshed when something changed
+    dirty = False
     try:
-        while stay_awake and (time.monotonic() - start_time < AWAKE_TIME):
+        while stay_awake:
+            # Read the clock once per tick and use it for the exit check, countdown and next wake
+            now = time.monotonic()
+            elapsed = now - start_time
+            if elapsed >= AWAKE_TIME:
+                break
+            
             # Calculate remaining time
-            remaining_time = int(AWAKE_TIME - (time.monotonic() - start_time))
+            remaining_time = int(AWAKE_TIME - elapsed)
             
             # ONLY update the countdown text, not the entire display
-            update_countdown(ui_elements, remaining_time)
+            if update_countdown(ui_elements, remaining_time):
+                dirty = True
             
-            # Check buttons with error handling
+            # Push this tick's label changes (countdown, hysteresis) in one refresh, if there were any
+            if dirty:
+                display.refresh()
+                dirty = False
+            
+            # Light sleep until the next countdown tick, a disarmed button re-arming, or a button press
+            # The tick lands on the next whole second of the window, so every timer wake
+            # changes the countdown rather than drifting and occasionally waking for nothing
+            wake_at = start_time + int(elapsed) + 1
+            armed_alarms = []
+            for i, pin_alarm in enumerate(BUTTON_ALARMS):
+                if pin_alarm is None:
+                    continue
+                if now >= armed_at[i]:
+                    armed_alarms.append(pin_alarm)
+                elif armed_at[i] < wake_at:
+                    wake_at = armed_at[i]
+            tick_alarm = alarm.time.TimeAlarm(monotonic_time=wake_at)
+            wake = alarm.light_sleep_until_alarms(tick_alarm, *armed_alarms)
+            if not isinstance(wake, alarm.pin.PinAlarm):
+                continue
+            
+            # Dispatch on the button that woke us
             try:
                 # D0: Decrease hysteresis (active LOW)
-                if buttons[0]["dio"] is not None:
-                    is_pressed = buttons[0]["active_low"] == (not buttons[0]["dio"].value)
-                    if is_pressed:
-                        hysteresis = max(MIN_HYSTERESIS, hysteresis - 0.5)  # Respect minimum from settings
-                        print(f"Hysteresis decreased to {hysteresis}cm")
-                        # ONLY update the hysteresis display element
-                        update_hysteresis(ui_elements, hysteresis)
-                        time.sleep(0.3)  # Debounce
+                if wake.pin == pin_d0:
+                    hysteresis = max(MIN_HYSTERESIS, hysteresis - 0.5)  # Respect minimum from settings
+                    print(f"Hysteresis decreased to {hysteresis}cm")
+                    # ONLY update the hysteresis display element - nothing to redraw if it was already at the limit
+                    if update_hysteresis(ui_elements, hysteresis):
+                        dirty = True
+                    armed_at[0] = time.monotonic() + DEBOUNCE_TIME
                 
                 # D1: Increase hysteresis (active HIGH)
-                if buttons[1]["dio"] is not None:
-                    is_pressed = buttons[1]["active_low"] == (not buttons[1]["dio"].value)
-                    if is_pressed:
-                        hysteresis = min(MAX_HYSTERESIS, hysteresis + 0.5)  # Respect maximum from settings
-                        print(f"Hysteresis increased to {hysteresis}cm")
-                        # ONLY update the hysteresis display element
-                        update_hysteresis(ui_elements, hysteresis)
-                        time.sleep(0.3)  # Debounce
+                elif wake.pin == pin_d1:
+                    hysteresis = min(MAX_HYSTERESIS, hysteresis + 0.5)  # Respect maximum from settings
+                    print(f"Hysteresis increased to {hysteresis}cm")
+                    # ONLY update the hysteresis display element - nothing to redraw if it was already at the limit
+                    if update_hysteresis(ui_elements, hysteresis):
+                        dirty = True
+                    armed_at[1] = time.monotonic() + DEBOUNCE_TIME
                 
                 # D2: Force report (active HIGH)
-                if buttons[2]["dio"] is not None:
-                    is_pressed = buttons[2]["active_low"] == (not buttons[2]["dio"].value)
-                    if is_pressed:
-                        print("Manual report requested")
-                        # Connect to WiFi if not already connected
-                        if not wifi.radio.connected:
-                            wifi_connected = connect_wifi()
-                        else:
-                            wifi_connected = True
-                        
-                        # Report to Adafruit IO if WiFi connected
-                        if wifi_connected:
-                            report_success = send_to_adafruit_io(current_distance)
-                            if report_success:
-                                last_report_time = time.monotonic()
-                                print("Manual report successful")
-                            else:
-                                print("Manual report failed")
-                        else:
-                            print("Could not connect to WiFi for manual report")
+                elif wake.pin == pin_d2:
+                    print("Manual report requested")
+                    if full_frequency:
+                        set_cpu_frequency(full_frequency)
+                    # Connect to WiFi, or reuse the link from the report at wake
+                    wifi_connected = connect_wifi()
                     
-                        # Reset the countdown timer regardless of success
-                        start_time = time.monotonic()
-                        time.sleep(0.3)  # Debounce
+                    # Report to Adafruit IO (along with anything still queued) if WiFi connected
+                    if wifi_connected:
+                        sync_clock()
+                        # The wake skipped sampling, so take a fresh reading for the report
+                        if skip_read:
+                            fresh_distance = read_distance()
+                            if fresh_distance > 0:
+                                current_distance = last_distance = fresh_distance
+                                update_current_distance(ui_elements, current_distance)
+                                dirty = True
+                            skip_read = False
+                        pending_readings.append(make_data_point(current_distance))
+                        pending_readings = pending_readings[-MAX_PENDING_POINTS:]
+                        last_reported_distance = current_distance
+                        report_success = send_batch_to_adafruit_io(pending_readings)
+                        if report_success:
+                            last_report_time = time.monotonic()
+                            pending_readings = []
+                            print("Manual report successful")
+                        else:
+                            print("Manual report failed")
+                    else:
+                        print("Could not connect to WiFi for manual report")
+                    wifi_off()
+                
+                    # Reset the countdown timer regardless of success
+                    start_time = time.monotonic()
+                    armed_at[2] = start_time + DEBOUNCE_TIME
+                    if full_frequency:
+                        set_cpu_frequency(80_000_000)
             except Exception as e:
                 print(f"Error during button handling: {e}")
-            
-            time.sleep(0.1)
     except Exception as e:
         print(f"Error in main interaction loop: {e}")
     
-    # Save state to a file with error handling
+    if full_frequency:
+        set_cpu_frequency(full_frequency)
+    
+    # Save state - hot fields always go to alarm.sleep_memory, which survives deep sleep without
+    # touching flash. NVM (or state.bin on boards without NVM) is only written every
+    # PERSIST_EVERY_WAKES wakes so a power loss loses little, or straight away while uploads are
+    # queued or the flags changed, so the flash copy never disagrees with state.json
+    has_pending = bool(pending_readings or pending_errors)
+    flags = STATE_FLAG_PENDING if has_pending else 0
+    persist = has_pending or flags != state_flags or wakes_until_persist <= 0
+    wakes_until_persist = PERSIST_EVERY_WAKES if persist else wakes_until_persist - 1
+    
+    saved_to_sleep_memory = False
     try:
+        saved_to_sleep_memory = save_state_to_sleep_memory(flags)
+    except Exception as e:
+        print(f"Error saving state to sleep memory: {e}")
+    
+    if persist or not saved_to_sleep_memory:
+        saved_to_nvm = False
         try:
-            # First try to write to the file system
-            with open("state.json", "w") as f:
-                json.dump({
-                    "last_report_time": last_report_time,
-                    "last_distance": last_distance,
-                    "past_readings": past_readings,
-                    "hysteresis": hysteresis
-                }, f)
-            print("State saved")
+            saved_to_nvm = save_state_to_nvm(flags)
+            if saved_to_nvm:
+                print("State saved to NVM")
+        except Exception as e:
+            print(f"Error saving state to NVM: {e}")
+        
+        if has_pending or not saved_to_nvm:
+            try:
+                try:
+                    # First try to write to the file system
+                    if not saved_to_nvm:
+                        save_state_to_file(flags)
+                    if has_pending and (pending_readings, pending_errors) != saved_pending:
+                        import json
+                        write_file_atomic("state.json", json.dumps({
+                            "pending_readings": pending_readings,
+                            "pending_errors": pending_errors
+                        }).encode())
+                    print("State saved")
+                except OSError as e:
+                    if "Read-only" in str(e):
+                        print("Warning: Read-only filesystem, state won't be saved")
+                    else:
+                        print(f"Error saving state: {e}")
+            except Exception as e:
+                print(f"Unexpected error saving state: {e}")
+    
+    # Queues drained - remove state.json so its uploads can't be picked up and sent again
+    # if the packed state is ever lost
+    if not has_pending and state_file_found:
+        try:
+            os.remove("state.json")
+            print("Upload queue cleared")
         except OSError as e:
-            if "Read-only" in str(e):
-                print("Warning: Read-only filesystem, state won't be saved")
-            else:
-                print(f"Error saving state: {e}")
-    except Exception as e:
-        print(f"Unexpected error saving state: {e}")
+            print(f"Could not remove state.json: {e}")
     
     # Calculate time until next wake
-    time_until_next_check = min(REPORT_INTERVAL, MIN_REPORT_INTERVAL - time_since_last_report)
-    if time_until_next_check < 0:
-        time_until_next_check = REPORT_INTERVAL
+    if level_moving:
+        check_interval = REPORT_INTERVAL // 4
+    else:
+        check_interval = REPORT_INTERVAL * (1 + stable_cycles)
+    # Measure the keepalive from now, since an upload this wake (or from D2) moves last_report_time;
+    # if it's overdue the upload failed, so keep to the normal interval rather than retrying at once
+    time_until_keepalive = int(MIN_REPORT_INTERVAL - (time.monotonic() - last_report_time))
+    if time_until_keepalive <= 0:
+        time_until_next_check = check_interval
+    else:
+        time_until_next_check = min(check_interval, max(time_until_keepalive, 60))
     
     print(f"Going to sleep for {time_until_next_check} seconds")
     
@@ -821,40 +1491,12 @@ def main():
         # Set up time alarm
         time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + time_until_next_check)
         
-        # Set up pin alarms for D0, D1, and D2
-        pin_alarms = []  # Start with time alarm
-        for button in buttons[1:]:
-            try:
-                # Access the pin directly from the dictionary
-                button_pin = button["pin"]
-                
-                # For alarm setup, we need to make sure we're not using the pins already in use
-                # First, close the DigitalInOut to release the pin if it was successfully set up
-                if button["dio"] is not None:
-                    button["dio"].deinit()
-                
-                # Then set up the pin alarm with the appropriate trigger value
-                # For active LOW buttons, we want to trigger on LOW (False)
-                # For active HIGH buttons, we want to trigger on HIGH (True)
-                alarm_value = not button["active_low"]  # Opposite of active state
-
-                # With a brief delay to ensure pin is released
-                time.sleep(0.1)
-                
-                try:
-                    print(f"Setting up alarm for {button}")
-                    pin_alarm = alarm.pin.PinAlarm(pin=button['pin'], value=not button['active_low'], pull=True)
-                    pin_alarms.append(pin_alarm)
-                    print(f"Alarm set for pin {button_pin}")
-                except Exception as e:
-                    print(f"Error setting up button alarm: {e}")
-            except Exception as e:
-                print(f"Error preparing button for alarm: {e}")
+        # Pin alarms for D1 and D2 - the pins were already released before the awake window,
+        # so the prebuilt alarms are reused as-is (each triggers on the button's pressed level)
+        pin_alarms = [pin_alarm for pin_alarm in BUTTON_ALARMS[1:] if pin_alarm is not None]
         
-        # Clear the display before sleep to save power
-        display.root_group = displayio.Group()
-        if backlight:
-            backlight.value = False
+        # Radio, session, display and sensor all off before sleeping
+        prep_deep_sleep()
         
         # Go to deep sleep, wake on any of the alarms
         if pin_alarms:
@@ -874,11 +1516,16 @@ try:
 except Exception as e:
     print(f"Critical error occurred: {e}")
     print("*** Traceback:")
+    import traceback
     traceback.print_exception(e)
     time.sleep(3)
     # Display error on screen
     try:
-        error_group = displayio.Group()
+        from adafruit_display_text import label
+        # Reuse the main group rather than allocating another one - drop whatever it was showing
+        error_group = main_group
+        while len(error_group) > 0:
+            error_group.pop()
         error_text1 = label.Label(terminalio.FONT, text="ERROR:", scale=2, color=0xFF0000)
         error_text1.x = 10
         error_text1.y = 40
@@ -917,6 +1564,7 @@ except Exception as e:
         
         # Show error on display
         board.DISPLAY.root_group = error_group
+        board.DISPLAY.auto_refresh = True
         time.sleep(10)  # Show error for 10 seconds
     except Exception as display_error:
         print(f"Error showing error screen: {display_error}")